@@ -1,14 +1,27 @@
+from contextvars import ContextVar
 from sqlalchemy import create_engine, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 # Создание движка базы данных
 SQLALCHEMY_DATABASE_URL = "sqlite:///./books.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True
+)
 
 # Создание сессии
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Область видимости сессии - текущий запрос.
+# Хранится в contextvar, а не в потоке: обработчик и зависимости FastAPI
+# могут выполняться в разных потоках пула одного и того же запроса.
+request_scope: ContextVar[object] = ContextVar("request_scope", default=None)
+SessionScoped = scoped_session(SessionLocal, scopefunc=request_scope.get)
+
 # Базовый класс для моделей
 Base = declarative_base()
 
@@ -19,16 +32,13 @@ class BookDB(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
     author = Column(String(100), nullable=False)
-    year = Column(Integer, nullable=False)
-    isbn = Column(String(13), nullable=True)
+    year = Column(Integer, nullable=False, index=True)
+    isbn = Column(String(13), nullable=True, unique=True, index=True)
 
 # Создание таблиц
 Base.metadata.create_all(bind=engine)
 
-# Функция для получения сессии базы данных
+# Функция для получения сессии базы данных.
+# Сессия закрывается middleware по завершении запроса (SessionScoped.remove()).
 def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+    return SessionScoped()
@@ -1,3 +1,4 @@
+from sqlalchemy import select, literal
 from database import SessionLocal, BookDB
 
 def init_database():
@@ -5,7 +6,8 @@ def init_database():
     db = SessionLocal()
 
     # Проверяем, есть ли уже данные в базе
-    if db.query(BookDB).count() > 0:
+    already = db.execute(select(literal(1)).select_from(BookDB).limit(1)).first() is not None
+    if already:
         print("База данных уже содержит данные, инициализация не требуется.")
         db.close()
         return
@@ -32,16 +34,13 @@ def init_database():
         }
     ]
 
-    # Добавляем книги в базу данных
-    for book_data in initial_books:
-        book = BookDB(**book_data)
-        db.add(book)
-
+    # Добавляем книги в базу данных одним INSERT
+    db.bulk_insert_mappings(BookDB, initial_books)
     db.commit()
     print(f"Добавлено {len(initial_books)} книг в базу данных.")
 
     # Выводим список добавленных книг
-    books = db.query(BookDB).all()
+    books = db.execute(select(BookDB.id, BookDB.title, BookDB.author, BookDB.year)).all()
     print("\nСписок книг в базе данных:")
     for book in books:
         print(f"ID: {book.id}, Название: {book.title}, Автор: {book.author}, Год: {book.year}")
@@ -1,10 +1,16 @@
-from fastapi import FastAPI, HTTPException, status, Depends, Security
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from fastapi import FastAPI, HTTPException, status, Depends, Request, Response
+from pydantic import BaseModel, Field, AfterValidator
+from typing import Optional, List, TypedDict, Annotated
 from datetime import datetime
+import time
+import hashlib
+import threading
+from sqlalchemy import select, insert, update, delete, func, bindparam
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from database import get_db, BookDB
+from database import get_db, BookDB, SessionScoped, request_scope
 from auth import verify_api_key
+import msgspec
 
 # Создание приложения FastAPI
 app = FastAPI(
@@ -13,28 +19,103 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Middleware: отдельная сессия базы данных на каждый запрос
+@app.middleware("http")
+async def db_session_middleware(request: Request, call_next):
+    token = request_scope.set(object())
+    try:
+        return await call_next(request)
+    finally:
+        SessionScoped.remove()
+        request_scope.reset(token)
+
+# Проверка года издания: текущий год вычисляется при каждом запросе,
+# а не один раз при импорте модуля
+def check_year(year: int) -> int:
+    if year > datetime.now().year:
+        raise ValueError("Год издания не может быть больше текущего")
+    return year
+
+Year = Annotated[int, AfterValidator(check_year)]
+
+# ETag книги: хэш всех отдаваемых столбцов, меняется при любом изменении данных
+def book_etag(book) -> str:
+    digest = hashlib.blake2b(repr(tuple(book)).encode(), digest_size=8).hexdigest()
+    return f'W/"{book.id}-{digest}"'
+
+# Слабое сравнение ETag с заголовком If-None-Match (префикс W/ не учитывается)
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+# Нарушено ли ограничение уникальности ISBN (а не другое ограничение таблицы)
+def is_isbn_conflict(exc: IntegrityError) -> bool:
+    message = str(exc.orig)
+    return "books.isbn" in message or "ix_books_isbn" in message
+
 # Модели Pydantic
 class Book(BaseModel):
     id: Optional[int] = None
     title: str = Field(..., min_length=1, max_length=200, description="Название книги")
     author: str = Field(..., min_length=1, max_length=100, description="Автор книги")
-    year: int = Field(..., ge=1000, le=datetime.now().year, description="Год издания")
+    year: Year = Field(..., ge=1000, description="Год издания")
     isbn: Optional[str] = Field(None, min_length=10, max_length=13, description="ISBN книги")
 
 class BookUpdate(BaseModel):
     title: Optional[str] = Field(None, min_length=1, max_length=200, description="Название книги")
     author: Optional[str] = Field(None, min_length=1, max_length=100, description="Автор книги")
-    year: Optional[int] = Field(None, ge=1000, le=datetime.now().year, description="Год издания")
+    year: Optional[Year] = Field(None, ge=1000, description="Год издания")
     isbn: Optional[str] = Field(None, min_length=10, max_length=13, description="ISBN книги")
 
+# Книга в ответе API (только для сериализации, без валидации)
+class BookDict(TypedDict):
+    id: int
+    title: str
+    author: str
+    year: int
+    isbn: Optional[str]
+
+# Столбцы книги, выбираемые для ответа
+BOOK_COLUMNS = (BookDB.id, BookDB.title, BookDB.author, BookDB.year, BookDB.isbn)
+
+# Запросы по ID книги (строятся один раз, ID передается параметром book_id)
+GET_BOOK_BY_ID = select(*BOOK_COLUMNS).where(BookDB.id == bindparam("book_id"))
+DELETE_BOOK_BY_ID = (
+    delete(BookDB)
+    .where(BookDB.id == bindparam("book_id"))
+    .returning(BookDB.id)
+    .execution_options(synchronize_session=False)
+)
+
+# Изменяемые поля книги (все, кроме ID)
+BOOK_FIELDS = ("title", "author", "year", "isbn")
+
+# Кодировщик JSON (создается один раз при импорте)
+BOOK_ENCODER = msgspec.json.Encoder()
+
+# Кэш статистики: значение, момент истечения (time.monotonic()) и поколение.
+# Каждое изменение книг увеличивает поколение; результат, посчитанный
+# до изменения, в кэш не попадает.
+STATS_TTL = 30
+STATS_CACHE = {"value": None, "expires": 0.0, "generation": 0}
+STATS_LOCK = threading.Lock()
+
+def invalidate_statistics():
+    with STATS_LOCK:
+        STATS_CACHE["generation"] += 1
+        STATS_CACHE["expires"] = 0.0
+
 # GET /api/books - Получение списка всех книг
 @app.get("/api/books", response_model=List[Book], tags=["Books"])
-async def get_books(
+def get_books(
     skip: int = 0,
     limit: int = 10,
     author: Optional[str] = None,
     year_from: Optional[int] = None,
     year_to: Optional[int] = None,
+    after_id: Optional[int] = None,
     db: Session = Depends(get_db)
 ):
     """
@@ -44,136 +125,211 @@ async def get_books(
     - **author**: Фильтр по автору (частичное совпадение)
     - **year_from**: Минимальный год издания
     - **year_to**: Максимальный год издания
+    - **after_id**: ID последней полученной книги (курсорная пагинация вместо skip).
+      ID последней книги страницы возвращается в заголовке X-Next-After-Id
     """
-    query = db.query(BookDB)
+    stmt = select(*BOOK_COLUMNS)
     
     if author:
-        query = query.filter(BookDB.author.ilike(f"%{author}%"))
+        stmt = stmt.where(BookDB.author.ilike(f"%{author}%"))
     if year_from:
-        query = query.filter(BookDB.year >= year_from)
+        stmt = stmt.where(BookDB.year >= year_from)
     if year_to:
-        query = query.filter(BookDB.year <= year_to)
+        stmt = stmt.where(BookDB.year <= year_to)
     
-    books = query.offset(skip).limit(limit).all()
-    return books
+    if after_id is not None:
+        stmt = stmt.where(BookDB.id > after_id).order_by(BookDB.id)
+    else:
+        stmt = stmt.offset(skip)
+
+    rows = db.execute(stmt.limit(limit)).all()
+    books: List[BookDict] = [
+        {"id": r[0], "title": r[1], "author": r[2], "year": r[3], "isbn": r[4]}
+        for r in rows
+    ]
+    response = Response(BOOK_ENCODER.encode(books), media_type="application/json")
+    if after_id is not None and books:
+        response.headers["X-Next-After-Id"] = str(books[-1]["id"])
+    return response
 
 # GET /api/books/{book_id} - Получение книги по ID
 @app.get("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def get_book(book_id: int, db: Session = Depends(get_db)):
+def get_book(book_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
     """
     Возвращает информацию о книге с указанным ID.
     Если книга не найдена, возвращается ошибка 404.
+    Ответ содержит заголовок ETag; если он совпадает с If-None-Match,
+    возвращается 304 без тела.
     """
-    book = db.query(BookDB).filter(BookDB.id == book_id).first()
-    if book:
-        return book
-    raise HTTPException(
-        status_code=status.HTTP_404_NOT_FOUND,
-        detail=f"Книга с ID {book_id} не найдена"
-    )
+    book = db.execute(GET_BOOK_BY_ID, {"book_id": book_id}).first()
+    if not book:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Книга с ID {book_id} не найдена"
+        )
+
+    etag = book_etag(book)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return book
 
 # POST /api/books - Создание новой книги (требуется аутентификация)
 @app.post("/api/books", response_model=Book, status_code=status.HTTP_201_CREATED, tags=["Books"])
-async def create_book(book: Book, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
+def create_book(book: Book, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
     """
     Создать новую книгу.
     Принимает данные новой книги и добавляет её в систему.
     Автоматически генерирует уникальный ID для книги.
     Возвращает созданную книгу с присвоенным ID.
+    Если книга с таким ISBN уже существует, возвращается ошибка 409.
     """
-    db_book = BookDB(**book.model_dump(exclude={"id"}))
-    db.add(db_book)
-    db.commit()
-    db.refresh(db_book)
+    stmt = (
+        insert(BookDB)
+        .values({field: getattr(book, field) for field in BOOK_FIELDS})
+        .returning(*BOOK_COLUMNS)
+    )
+    try:
+        db_book = db.execute(stmt).first()
+        db.commit()
+    except IntegrityError as exc:
+        db.rollback()
+        if not is_isbn_conflict(exc):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Книга с ISBN {book.isbn} уже существует"
+        )
+    invalidate_statistics()
     return db_book
 
 # PUT /api/books/{book_id} - Полное обновление книги (требуется аутентификация)
 @app.put("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def update_book(book_id: int, updated_book: Book, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
+def update_book(book_id: int, updated_book: Book, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
     """
     Полностью обновить информацию о книге.
     - **book_id**: ID книги для обновления
     - **updated_book**: Новые данные книги (все поля обязательны)
     Заменяет все данные книги новыми значениями.
     Если книга не найдена, возвращается ошибка 404.
+    Если книга с таким ISBN уже существует, возвращается ошибка 409.
     """
-    book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    stmt = (
+        update(BookDB)
+        .where(BookDB.id == bindparam("book_id"))
+        .values({field: getattr(updated_book, field) for field in BOOK_FIELDS})
+        .returning(*BOOK_COLUMNS)
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        book = db.execute(stmt, {"book_id": book_id}).first()
+    except IntegrityError as exc:
+        db.rollback()
+        if not is_isbn_conflict(exc):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Книга с ISBN {updated_book.isbn} уже существует"
+        )
     if not book:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Книга с ID {book_id} не найдена"
         )
-    
-    for field, value in updated_book.model_dump(exclude={"id"}).items():
-        setattr(book, field, value)
-    
+
     db.commit()
-    db.refresh(book)
+    invalidate_statistics()
     return book
 
 # PATCH /api/books/{book_id} - Частичное обновление книги (требуется аутентификация)
 @app.patch("/api/books/{book_id}", response_model=Book, tags=["Books"])
-async def partial_update_book(book_id: int, book_update: BookUpdate, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
+def partial_update_book(book_id: int, book_update: BookUpdate, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
     """
     Частично обновить информацию о книге.
     - **book_id**: ID книги для обновления
     - **book_update**: Данные для обновления (только указанные поля будут изменены)
     Обновляет только те поля, которые были переданы в запросе.
     Если книга не найдена, возвращается ошибка 404.
+    Если книга с таким ISBN уже существует, возвращается ошибка 409.
     """
-    book = db.query(BookDB).filter(BookDB.id == book_id).first()
+    update_data = {field: getattr(book_update, field) for field in book_update.model_fields_set}
+    if update_data:
+        stmt = (
+            update(BookDB)
+            .where(BookDB.id == bindparam("book_id"))
+            .values(update_data)
+            .returning(*BOOK_COLUMNS)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        stmt = GET_BOOK_BY_ID
+    try:
+        book = db.execute(stmt, {"book_id": book_id}).first()
+    except IntegrityError as exc:
+        db.rollback()
+        if not is_isbn_conflict(exc):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Книга с ISBN {book_update.isbn} уже существует"
+        )
     if not book:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Книга с ID {book_id} не найдена"
         )
-    
-    update_data = book_update.model_dump(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(book, field, value)
-    
+
     db.commit()
-    db.refresh(book)
+    invalidate_statistics()
     return book
 
 # GET /api/stats/books - Получение статистики
 @app.get("/api/stats/books", tags=["Statistics"])
-async def get_statistics(db: Session = Depends(get_db)):
+def get_statistics(db: Session = Depends(get_db)):
     """
     Получить статистику по книгам.
     Возвращает общее количество книг, распределение по авторам и векам.
+    Результат кэшируется на 30 секунд и сбрасывается при изменении книг.
     """
-    from collections import Counter
+    with STATS_LOCK:
+        if time.monotonic() < STATS_CACHE["expires"]:
+            return STATS_CACHE["value"]
+        generation = STATS_CACHE["generation"]
 
-    books = db.query(BookDB).all()
-    total_books = len(books)
-    authors = Counter(book.author for book in books)
-    centuries = Counter(book.year // 100 + 1 for book in books)
+    century_expr = (BookDB.year // 100 + 1).label("century")
+    authors = dict(db.execute(select(BookDB.author, func.count()).group_by(BookDB.author)).all())
+    centuries = dict(db.execute(select(century_expr, func.count()).group_by(century_expr)).all())
 
-    return {
-        "total_books": total_books,
-        "books_by_author": dict(authors),
+    statistics = {
+        "total_books": sum(authors.values()),
+        "books_by_author": authors,
         "books_by_century": {f"{century} век": count for century, count in centuries.items()}
     }
+    with STATS_LOCK:
+        if STATS_CACHE["generation"] == generation:
+            STATS_CACHE["value"] = statistics
+            STATS_CACHE["expires"] = time.monotonic() + STATS_TTL
+    return statistics
 
 # DELETE /api/books/{book_id} - Удаление книги (требуется аутентификация)
 @app.delete("/api/books/{book_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Books"])
-async def delete_book(book_id: int, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
+def delete_book(book_id: int, api_key: str = Depends(verify_api_key), db: Session = Depends(get_db)):
     """
     Удалить книгу по ID.
     - **book_id**: ID книги для удаления
     Удаляет книгу из системы.
     Если книга не найдена, возвращается ошибка 404.
     """
-    book = db.query(BookDB).filter(BookDB.id == book_id).first()
-    if not book:
+    deleted_id = db.execute(DELETE_BOOK_BY_ID, {"book_id": book_id}).scalar_one_or_none()
+    if deleted_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Книга с ID {book_id} не найдена"
         )
 
-    db.delete(book)
     db.commit()
+    invalidate_statistics()
     return
 
 # Точка входа для запуска приложения